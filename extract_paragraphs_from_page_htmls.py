@@ -12,13 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
-import gzip
-import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
 from unicodedata import normalize
 
-from bs4 import BeautifulSoup
+import orjson
 from logzero import logger
+from selectolax.lexbor import LexborHTMLParser
 from tqdm import tqdm
+from xopen import xopen
 
 
 DEFAULT_SECTIONS_TO_IGNORE = ["脚注", "出典", "参考文献", "関連項目", "外部リンク"]
@@ -26,69 +31,166 @@ DEFAULT_TAGS_TO_REMOVE = ["table"]
 # DEFAULT_TAGS_TO_EXTRACT = ["p"]
 DEFAULT_TAGS_TO_EXTRACT = ["p", "h3", "h4", "h5", "h6", "dt", "dd", "li", "th", "tr"]
 DEFAULT_INNER_TAGS_TO_REMOVE = ["sup"]
+SECTION_KEYS = ("h2", "h3", "h4", "dt")
+# 出力ファイルへの書き込みをまとめて行う単位（バイト数）
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+
+class NonPrintableCharsTable(dict):
+    # str.translate()用の変換表。印字不可能な文字をNoneに（削除）、それ以外をそのままに対応させる
+    # 全コードポイント分の表は大きすぎるため、出現した文字についてのみ判定結果を記憶する
+    def __missing__(self, code):
+        value = code if chr(code).isprintable() else None
+        self[code] = value
+        return value
+
+
+NON_PRINTABLE_CHARS_TABLE = NonPrintableCharsTable()
 
 
 def normalize_text(text):
+    # unicodedata.normalize()は内部でQuick Checkを行い、正規化済みのテキストはそのまま返すため、
+    # is_normalized()による事前の判定は行わない
     text = normalize("NFKC", text)
     text = " ".join(text.split())
-    text = "".join(char for char in text if char.isprintable())
+    # ほとんどのテキストは印字可能文字のみからなるため、1文字ずつの判定は必要な場合に限る
+    if not text.isprintable():
+        text = text.translate(NON_PRINTABLE_CHARS_TABLE)
     text = text.strip()
     return text
 
 
-def extract_paragraphs_from_html(html, tags_to_extract, tags_to_remove, inner_tags_to_remove):
-    soup = BeautifulSoup(html, features="lxml")
+def extract_paragraphs_from_html(
+    html,
+    page_id,
+    rev_id,
+    title,
+    tags_to_extract,
+    tags_to_remove,
+    inner_tags_to_remove,
+    sections_to_ignore,
+    min_paragraph_length,
+    max_paragraph_length,
+):
+    # 中間のタプルやリストを作らないよう、段落のフィルタリングとJSONへのシリアライズもここで行う
+    tree = LexborHTMLParser(html)
+    # BeautifulSoupの.textと同様に、スタイルシートやスクリプトの中身はテキストに含めない
+    tree.strip_tags(["style", "script", "template"])
     h2 = None
     h3 = None
     h4 = None
     dt = None
 
-    section = soup.find(["section"])
-    while section:
-        if section.h2 is not None:
-            h2 = section.h2.text
+    id_prefix = f"{page_id}-{rev_id}-"
+    paragraph_index = 0
+
+    # 見出し・除去対象・抽出対象のタグを、1つのセレクタで文書順にまとめて取得する
+    selector = ", ".join("section " + tag for tag in ["h2"] + tags_to_remove + tags_to_extract)
+
+    # これらのタグの配下の場合、先に親要素のテキストが取得されている（または除去されている）ためスキップする
+    parent_tags_to_skip = {"dd", "li", "th", "tr", *tags_to_remove}
+
+    for tag in tree.css(selector):
+        # sectionはこれらのタグの配下には現れないため、祖先の確認は直近のsectionまでで打ち切る
+        skip = False
+        parent = tag.parent
+        while parent is not None and parent.tag != "section":
+            if parent.tag in parent_tags_to_skip:
+                skip = True
+                break
+            parent = parent.parent
+        if skip:
+            continue
+
+        if tag.tag in tags_to_remove:
+            # 配下のタグはツリーから切り離された後も上のチェックでスキップされる
+            tag.decompose(recursive=False)
+            continue
+
+        if tag.tag == "h2":
+            h2 = tag.text()
             h3 = None
             h4 = None
             dt = None
+            continue
+
+        # 無視するセクションでは、次のh2が現れるまで何も出力しないため、テキストの取得自体を省く
+        if h2 in sections_to_ignore:
+            continue
+
+        tag.strip_tags(tags_to_remove + inner_tags_to_remove)
+
+        # h3→h4→dtの順序の階層を前提に、上位の階層が変化したら下位の階層をリセットする
+        if tag.tag == "h3":
+            h3 = tag.text()
+            h4 = None
+            dt = None
+            continue
+
+        if tag.tag == "h4":
+            h4 = tag.text()
+            dt = None
+            continue
+
+        if tag.tag == "dt":
+            dt = tag.text()
+            continue
 
-        for tag in section.find_all(tags_to_remove):
-            tag.clear()
+        paragraph_text = normalize_text(tag.text())
+        if len(paragraph_text) < min_paragraph_length:
+            continue
+        if len(paragraph_text) > max_paragraph_length:
+            continue
 
-        tags = section.find_all(tags_to_extract)
-        for tag in tags:
+        sections_dict = {key: value for key, value in zip(SECTION_KEYS, (h2, h3, h4, dt)) if value is not None}
 
-            # これらのタグの配下の場合、先に親要素のテキストが取得されているためスキップする
-            skip = False
-            for parent_tag in ["dd", "li", "th", "tr"]:
-                if tag.find_parent(parent_tag):
-                    skip = True
-                    break
-            if skip:
-                continue
+        yield orjson.dumps({
+            "id": id_prefix + str(paragraph_index),
+            "pageid": page_id,
+            "revid": rev_id,
+            "paragraph_index": paragraph_index,
+            "title": title,
+            "section": sections_dict,
+            "text": paragraph_text,
+            "html_tag": tag.tag,
+        })
+        paragraph_index += 1
 
-            for inner_tag in tag.find_all(inner_tags_to_remove):
-                inner_tag.clear()
 
-            # h3→h4→dtの順序の階層を前提に、上位の階層が変化したら下位の階層をリセットする
-            if tag.name == "h3":
-                h3 = tag.text
-                h4 = None
-                dt = None
-                continue
+def process_page(
+    line,
+    tags_to_extract,
+    tags_to_remove,
+    inner_tags_to_remove,
+    sections_to_ignore,
+    min_paragraph_length,
+    max_paragraph_length,
+):
+    input_item = orjson.loads(line)
+    return list(extract_paragraphs_from_html(
+        input_item["html"],
+        input_item["pageid"],
+        input_item["revid"],
+        input_item["title"],
+        tags_to_extract,
+        tags_to_remove,
+        inner_tags_to_remove,
+        sections_to_ignore,
+        min_paragraph_length,
+        max_paragraph_length,
+    ))
 
-            if tag.name == "h4":
-                h4 = tag.text
-                dt = None
-                continue
 
-            if tag.name == "dt":
-                dt = tag.text
-                continue
+def process_pages(lines, **kwargs):
+    return [process_page(line, **kwargs) for line in lines]
 
-            paragraph_text = normalize_text(tag.text)
-            yield ([h2, h3, h4, dt], paragraph_text, tag.name)
 
-        section = section.find_next_sibling(["section"])
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be a positive integer: {}".format(value))
+
+    return value
 
 
 def main(args):
@@ -117,48 +219,50 @@ def main(args):
     logger.info("inner_tags_to_remove: %s", inner_tags_to_remove)
     logger.info("sections_to_ignore: %s", sections_to_ignore)
 
-    with gzip.open(args.page_htmls_file, "rt") as f, gzip.open(args.output_file, "wt") as fo:
-        for line in tqdm(f):
-            input_item = json.loads(line.rstrip("\n"))
-            page_id = input_item["pageid"]
-            rev_id = input_item["revid"]
-            title = input_item["title"]
-            html = input_item["html"]
-
-            paragraph_index = 0
-            for item in extract_paragraphs_from_html(html, tags_to_extract, tags_to_remove, inner_tags_to_remove):
-                sections, paragraph_text, tag_name = item
-
-                if sections[0] in sections_to_ignore:
-                    continue
-                if len(paragraph_text) < args.min_paragraph_length:
-                    continue
-                if len(paragraph_text) > args.max_paragraph_length:
-                    continue
-
-                sections_dict = {}
-                if sections[0] is not None:
-                    sections_dict["h2"] = sections[0]
-                if sections[1] is not None:
-                    sections_dict["h3"] = sections[1]
-                if sections[2] is not None:
-                    sections_dict["h4"] = sections[2]
-                if sections[3] is not None:
-                    sections_dict["dt"] = sections[3]
-
-
-                output_item = {
-                    "id": "{}-{}-{}".format(page_id, rev_id, paragraph_index),
-                    "pageid": page_id,
-                    "revid": rev_id,
-                    "paragraph_index": paragraph_index,
-                    "title": title,
-                    "section": sections_dict,
-                    "text": paragraph_text,
-                    "html_tag": tag_name,
-                }
-                print(json.dumps(output_item, ensure_ascii=False), file=fo)
-                paragraph_index += 1
+    process_pages_fn = partial(
+        process_pages,
+        tags_to_extract=tags_to_extract,
+        tags_to_remove=tags_to_remove,
+        inner_tags_to_remove=inner_tags_to_remove,
+        sections_to_ignore=sections_to_ignore,
+        min_paragraph_length=args.min_paragraph_length,
+        max_paragraph_length=args.max_paragraph_length,
+    )
+
+    # 入力ファイル全体をメモリに載せないよう、batch_sizeページずつのタスクを同時に最大num_workers * 2個まで投入する
+    # タスクの結果は投入した順に取り出すため、paragraph_indexを含む出力の順序は変わらない
+    max_pending_tasks = args.num_workers * 2
+    with xopen(args.page_htmls_file, "rb") as f, xopen(args.output_file, "wb", compresslevel=9) as fo, \
+         ProcessPoolExecutor(max_workers=args.num_workers) as executor, tqdm() as pbar:
+        buffer = bytearray()
+
+        def write_outputs(task):
+            outputs = task.result()
+            for output_lines in outputs:
+                for output_line in output_lines:
+                    buffer.extend(output_line)
+                    buffer.extend(b"\n")
+
+            if len(buffer) >= OUTPUT_BUFFER_SIZE:
+                fo.write(buffer)
+                buffer.clear()
+
+            pbar.update(len(outputs))
+
+        pending_tasks = deque()
+        while True:
+            lines = list(islice(f, args.batch_size))
+            if len(lines) == 0:
+                break
+
+            pending_tasks.append(executor.submit(process_pages_fn, lines))
+            if len(pending_tasks) >= max_pending_tasks:
+                write_outputs(pending_tasks.popleft())
+
+        while len(pending_tasks) > 0:
+            write_outputs(pending_tasks.popleft())
+
+        fo.write(buffer)
 
 
 if __name__ == "__main__":
@@ -171,5 +275,7 @@ if __name__ == "__main__":
     parser.add_argument("--sections_to_ignore", nargs="+", type=str)
     parser.add_argument("--min_paragraph_length", type=int, default=10)
     parser.add_argument("--max_paragraph_length", type=int, default=1000)
+    parser.add_argument("--num_workers", type=positive_int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch_size", type=positive_int, default=64)
     args = parser.parse_args()
     main(args)
@@ -12,15 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
-import gzip
-import json
+import re
+from functools import lru_cache
 from typing import Callable, Optional
 
+import orjson
 from tqdm import tqdm
+from xopen import xopen
 
 from sentence_splitters import MeCabSentenceSplitter
 
-import re
+
+NEWLINES_REGEX = re.compile(r"\n+")
+# 出力ファイルへの書き込みをまとめて行う単位（バイト数）
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+
+def cache_sentence_splitter(splitter, maxsize=65536):
+    # Wikipediaには短い重複した行（リスト項目や日付など）が多いため、行ごとの文分割の結果をキャッシュする
+    @lru_cache(maxsize=maxsize)
+    def cached_splitter(line):
+        return tuple(splitter(line))
+
+    return cached_splitter
+
+
 def split_section(text, splitter, max_nchar=750):
     # textを、max_ncharにおおむね収まる、互いに長さが近い複数のチャンクに分割する
 
@@ -45,13 +61,17 @@ def split_section(text, splitter, max_nchar=750):
     sentences = []
 
     # 文の分割
-    for line in re.split(r'\n+', text):
-        sentences += splitter(line)
+    for line in NEWLINES_REGEX.split(text):
+        # 空白のみの行は文分割器（MeCab）に渡さない
+        if not line.strip():
+            continue
+
+        sentences.extend(splitter(line))
         if len(sentences) > 0:
             sentences[-1] = sentences[-1] + "\n"
 
     chunks = []
-    chunk_text = ""
+    chunk_sentences = []
     for sentence in sentences:
         l = len(sentence)
         
@@ -59,17 +79,17 @@ def split_section(text, splitter, max_nchar=750):
         if nchar + l//2 >= nchar_chunk*(chunk_id):
             if chunk_id != nchunk:
                 chunk_id += 1
-                chunks.append(chunk_text.strip())
-                chunk_text = ""
+                chunks.append("".join(chunk_sentences).strip())
+                chunk_sentences = []
             else:
                 # 最終チャンクはmax_charを超えてもそこに詰める
                 pass
 
         nchar += l
-        chunk_text += sentence
+        chunk_sentences.append(sentence)
         
-    if chunk_text != "":
-        chunks.append(chunk_text.strip())
+    if len(chunk_sentences) > 0:
+        chunks.append("".join(chunk_sentences).strip())
     
     return chunks
 
@@ -79,33 +99,29 @@ def generate_passages(
     sentence_splitter: Optional[Callable] = None
 ):
     
-    with gzip.open(paragraphs_file, "rt") as f:
-        data = []
-        for line in f.readlines():
-            data.append(json.loads(line))
-
+    with xopen(paragraphs_file, "rb") as f:
         passage_id = 0
         section_rows = []
-        lastrow = data[0]
+        lastrow = None
 
-        for row in tqdm(data):
+        for line in tqdm(f):
+            row = orjson.loads(line)
             title = row["title"]
             section = row["section"]
 
             # titleまたはsectionが変わった場合、そこまでのデータを出力する
-            if title != lastrow["title"] or section != lastrow["section"]:
+            if lastrow is not None and (title != lastrow["title"] or section != lastrow["section"]):
 
                 section_text = "\n".join([r["text"] for r in section_rows])
                 for chunk in split_section(section_text, sentence_splitter, max_passage_length):
-                    output_item = json.dumps(
-                        {
-                            "id": passage_id,
-                            "pageid": lastrow["pageid"],
-                            "revid": lastrow["revid"],
-                            "title": lastrow["title"],
-                            "section": lastrow["section"],
-                            "text": chunk
-                        }, ensure_ascii=False)
+                    output_item = {
+                        "id": passage_id,
+                        "pageid": lastrow["pageid"],
+                        "revid": lastrow["revid"],
+                        "title": lastrow["title"],
+                        "section": lastrow["section"],
+                        "text": chunk
+                    }
                     yield output_item
 
                     passage_id += 1
@@ -116,16 +132,23 @@ def generate_passages(
 
 
 def main(args: argparse.Namespace):
-    sentence_splitter = MeCabSentenceSplitter(args.mecab_option)
+    sentence_splitter = cache_sentence_splitter(MeCabSentenceSplitter(args.mecab_option))
 
-    with gzip.open(args.output_file, "wt") as fo:
+    with xopen(args.output_file, "wb", compresslevel=9) as fo:
         passage_generator = generate_passages(
             paragraphs_file=args.paragraphs_file,
             max_passage_length=args.max_passage_length,
             sentence_splitter=sentence_splitter
         )
+        buffer = bytearray()
         for passage_item in tqdm(passage_generator):
-            print(json.dumps(passage_item, ensure_ascii=False), file=fo)
+            buffer += orjson.dumps(passage_item)
+            buffer += b"\n"
+            if len(buffer) >= OUTPUT_BUFFER_SIZE:
+                fo.write(buffer)
+                buffer.clear()
+
+        fo.write(buffer)
 
 
 if __name__ == "__main__":